@@ -2,7 +2,6 @@
 
 module load miniconda/3-22.11 > /dev/null 2>&1
 module load singularity/3.8.3
-module load fsl/6.0.3
 
 fsLicense="/appl/freesurfer-7.1.1/license.txt"
 
@@ -12,11 +11,12 @@ scriptDir=$(dirname "${scriptPath}")
 repoDir=${scriptDir%/bin}
 
 numThreads=1
+parallelGroups=1
 synB0Version="3.0"
 
 function usage() {
   echo "Usage:
-  $0 -i bids_dataset [-n num_cores=1] [-s sessions.csv] [-v synb0_version=3.0] -- [options to bidsSynB0.py]
+  $0 -i bids_dataset [-n num_cores=1] [-p parallel_groups=1] [-s sessions.csv] [-v synb0_version=3.0] -- [options to bidsSynB0.py]
 
   $0 -h for help
   "
@@ -49,7 +49,11 @@ cat << HELP
        Path to BIDS dataset to process.
 
     -n num_cores
-       Number of cores to use (default=${numThreads}).
+       Number of cores to use for each synb0 run (default=${numThreads}).
+
+    -p parallel_groups
+       Number of DWI groups to run synb0 on at once (default=${parallelGroups}). The job requests
+       num_cores * parallel_groups slots.
 
     -s sessions.csv
        CSV file with subjectID,sessionID pairs to process. Each session will be submitted as a separate job.
@@ -63,6 +67,7 @@ cat << HELP
      -c / --container (set by -v in this wrapper)
      --bids-dataset (set by -i in this wrapper)
      -n / --num-threads (set by -n in this wrapper)
+     -p / --max-parallel-groups (set by -p in this wrapper)
      --fs-license-file (hard-coded to ${fsLicense})
 
   `conda run -p /project/ftdc_pipeline/ftdc-picsl/miniconda/envs/ftdc-picsl-cp311 ${repoDir}/scripts/bidsSynB0.py -h`
@@ -71,10 +76,11 @@ HELP
 
 }
 
-while getopts "i:n:s:v:h" opt; do
+while getopts "i:n:p:s:v:h" opt; do
   case $opt in
     i) inputBIDS=$OPTARG;;
     n) numThreads=$OPTARG;;
+    p) parallelGroups=$OPTARG;;
     s) sessionList=$OPTARG;;
     v) synB0Version=$OPTARG;;
     h) help; exit 1;;
@@ -85,6 +91,8 @@ done
 
 shift $((OPTIND-1))
 
+numSlots=$(( numThreads * parallelGroups ))
+
 date=`date +%Y%m%d`
 
 # Makes python output unbuffered, so we can tail the log file and see progress
@@ -102,11 +110,12 @@ echo
 if [[ -f "${sessionList}" ]]; then
   while IFS=, read -r subject session; do
     echo "Submitting session ${subject},${session}"
-    bsub -n $numThreads -cwd . -o "${logDir}/synb0_${date}_%J.txt" \
+    bsub -n $numSlots -cwd . -o "${logDir}/synb0_${date}_%J.txt" \
       conda run -p /project/ftdc_pipeline/ftdc-picsl/miniconda/envs/ftdc-picsl-cp311 ${repoDir}/scripts/bidsSynB0.py \
         --bids-dataset ${inputBIDS} \
         --container ${repoDir}/containers/synb0-${synB0Version}.sif \
         --num-threads $numThreads \
+        --max-parallel-groups $parallelGroups \
         --fs-license-file ${fsLicense} \
         --participant-label ${subject} \
         --session-label ${session} \
@@ -119,10 +128,11 @@ fi
 echo "Submitting single session with args: $*"
 echo
 
-bsub -n $numThreads -cwd . -o "${logDir}/synb0_${date}_%J.txt" \
+bsub -n $numSlots -cwd . -o "${logDir}/synb0_${date}_%J.txt" \
     conda run -p /project/ftdc_pipeline/ftdc-picsl/miniconda/envs/ftdc-picsl-cp311 ${repoDir}/scripts/bidsSynB0.py \
       --bids-dataset ${inputBIDS} \
       --container ${repoDir}/containers/synb0-${synB0Version}.sif \
       --num-threads $numThreads \
+      --max-parallel-groups $parallelGroups \
       --fs-license-file ${fsLicense} \
       $*
@@ -2,7 +2,11 @@
 
 import argparse
 import bids
+import concurrent.futures
+import fcntl
 import json
+import nibabel as nib
+import numpy as np
 import os
 import re
 import shutil
@@ -10,6 +14,21 @@ import subprocess
 import sys
 import tempfile
 
+from collections import namedtuple
+from pathlib import Path
+
+# BIDS key-value entities in a file name, eg sub-01_ses-MR1_acq-b1000_dwi.nii.gz
+ENTITY_RE = re.compile(r'(?:^|_)(?P<k>[a-zA-Z0-9]+)-(?P<v>[a-zA-Z0-9]+)')
+
+# File name keys to the entity names used by pybids
+ENTITY_NAMES = {'sub': 'subject', 'ses': 'session', 'acq': 'acquisition', 'dir': 'direction', 'run': 'run'}
+
+# Phase encoding direction in a JSON sidecar
+PE_DIRECTION_RE = re.compile(rb'"PhaseEncodingDirection"\s*:\s*"([^"]+)"')
+
+# Minimal stand-in for a pybids BIDSFile, for images found without a layout
+BIDSImage = namedtuple('BIDSImage', ['path', 'filename', 'entities'])
+
 def _filter_pybids_none_any(dct):
     import bids
     return {
@@ -24,7 +43,7 @@ def get_bids_filters(value):
 
     if value and Path(value).exists():
         try:
-            filters = loads(Path(value).read_text(), object_hook=_filter_pybids_none_any)
+            filters = json.loads(Path(value).read_text(), object_hook=_filter_pybids_none_any)
         except Exception as e:
             raise Exception("Unable to parse BIDS filter file. Check that it is "
                             "valid JSON.")
@@ -41,20 +60,75 @@ def get_bids_filters(value):
         }
     return filters
 
+def get_session_images(dataset, subject_label, session_label, datatype, suffix):
+    # Find images in a session datatype directory without indexing the dataset
+    image_dir = os.path.join(dataset, f"sub-{subject_label}", f"ses-{session_label}", datatype)
+    image_ending = f"_{suffix}.nii.gz"
+
+    images = []
+
+    if not os.path.isdir(image_dir):
+        return images
+
+    with os.scandir(image_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(image_ending) or entry.name.startswith('.'):
+                continue
+            entities = {ENTITY_NAMES.get(match.group('k'), match.group('k')): match.group('v')
+                        for match in ENTITY_RE.finditer(entry.name[:-len(image_ending)])}
+            images.append(BIDSImage(entry.path, entry.name, entities))
+
+    return sorted(images, key=lambda image: image.filename)
+
+
+def get_layout(dataset, indexer, participant_label, session_label, database_path=None):
+    if database_path is None:
+        return bids.BIDSLayout(dataset, indexer=indexer)
+
+    # Jobs may run concurrently, sqlite locking is not reliable on network file systems so only let one job at a
+    # time check or rebuild the database. Other jobs may be querying the database without the lock, so a new
+    # database is built separately and moved into place, rather than being reset in place
+    os.makedirs(database_path, exist_ok=True)
+    database_file = os.path.join(database_path, 'layout_index.sqlite')
+
+    with open(os.path.join(database_path, 'layout_index.lock'), 'w') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        # Rebuild the database if the dataset description has changed since it was created
+        reset_database = (not os.path.exists(database_file) or
+                          os.path.getmtime(os.path.join(dataset, 'dataset_description.json')) >
+                          os.path.getmtime(database_file))
+
+        if not reset_database:
+            layout = bids.BIDSLayout(dataset, indexer=indexer, database_path=database_path)
+            # Sessions added since the database was created are not in it
+            if session_label in layout.get_sessions(subject=participant_label):
+                return layout
+            print("Session " + session_label + " for subject " + participant_label + " not found in " +
+                  database_path)
+
+        print("Indexing BIDS dataset into " + database_path)
+        with tempfile.TemporaryDirectory(prefix='.layout_index.', dir=database_path,
+                                         ignore_cleanup_errors=True) as build_dir:
+            bids.BIDSLayout(dataset, indexer=indexer, database_path=build_dir, reset_database=True)
+            os.replace(os.path.join(build_dir, 'layout_index.sqlite'), database_file)
+
+        return bids.BIDSLayout(dataset, indexer=indexer, database_path=database_path)
+
+
 def get_dwi_images(layout, subject_label, session_label, filter_criteria):
-    dwi_images = layout.get(subject=subject_label, session=session_label, suffix='dwi', extension=['nii.gz'], **filter_criteria)
+    return layout.get(subject=subject_label, session=session_label, suffix='dwi', extension=['nii.gz'],
+                      **filter_criteria)
+
 
+def group_by_acquisition(dwi_images):
     # Images grouped by acquisition
     # Run synb0 once per group, make an fmap with intendedfor all DWIs in that group
     grouped_images = {}
 
     for file in dwi_images:
-        acq_label = file.get_entities()['acquisition']
-        if not acq_label:
-            acq_label = 'noacq'
-        if acq_label not in grouped_images:
-            grouped_images[acq_label] = []
-        grouped_images[acq_label].append(file)
+        # entities is loaded with the file, get_entities() queries the database for each file
+        acq_label = file.entities.get('acquisition') or 'noacq'
+        grouped_images.setdefault(acq_label, []).append(file)
 
     return grouped_images
 
@@ -63,36 +137,213 @@ def get_t1w_skull_stripped(dataset, participant_label, session_label, t1w_filena
     # Look in the mask dataset for a T1w mask matching the T1w image
     mask_dir = os.path.join(dataset, f"sub-{participant_label}", f"ses-{session_label}", 'anat')
     # Get all json files in the mask directory
-    mask_sidecars = [f for f in os.listdir(mask_dir) if f.endswith('_mask.json')]
+    with os.scandir(mask_dir) as entries:
+        mask_sidecars = [entry for entry in entries if entry.name.endswith('_mask.json') and entry.is_file()]
+
+    # Masks are usually named after the T1w, so check the conventional name first, then masks sharing the
+    # T1w entities, before parsing any other sidecars
+    t1w_stem = t1w_filename.rsplit('_', 1)[0]
+    expected_mask_sidecar = t1w_stem + '_desc-brain_mask.json'
+    mask_sidecars.sort(key=lambda entry: (entry.name != expected_mask_sidecar, t1w_stem not in entry.name))
 
     t1w_mask = None
     t1w_skull_stripped_path = None
 
-    found_mask = False
-
     for mask_sidecar in mask_sidecars:
         # Load the sidecar
-        with open(os.path.join(mask_dir, mask_sidecar)) as json_file:
+        with open(mask_sidecar.path) as json_file:
             mask_json = json.load(json_file)
-            # Check if the T1w image matches the T1w image in the mask sidecar
-            for source in mask_json['Sources']:
-                if source.endswith(t1w_filename):
-                    # Found a match
-                    t1w_mask = os.path.join(mask_dir, mask_sidecar.replace('.json', '.nii.gz'))
-                    found_mask = True
-                    break
-            if found_mask:
-                break
+        # Check if the T1w image matches the T1w image in the mask sidecar
+        if any(source.endswith(t1w_filename) for source in mask_json.get('Sources', [])):
+            # Found a match
+            t1w_mask = mask_sidecar.path.replace('.json', '.nii.gz')
+            break
 
     if t1w_mask is not None:
         print("Using T1w mask " + t1w_mask)
         t1w_skull_stripped_path = os.path.join(working_dir, "t1w_skull_stripped.nii.gz")
-        t1w_is_skull_stripped = True
-        subprocess.run(["fslmaths", t1w_path, "-mas", t1w_mask, t1w_skull_stripped_path])
+        t1w = nib.load(t1w_path)
+        mask = nib.load(t1w_mask)
+        t1w_skull_stripped = np.asanyarray(t1w.dataobj) * (np.asanyarray(mask.dataobj) > 0)
+        nib.save(nib.Nifti1Image(t1w_skull_stripped, t1w.affine, t1w.header), t1w_skull_stripped_path)
 
     return t1w_skull_stripped_path
 
 
+def link_or_copy(src, dst):
+    # Hard link if src and dst are on the same file system, avoids copying the data. Only use this for files
+    # that will not be modified afterwards
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def load_sidecar(image_path):
+    # Load the JSON sidecar for an image, same file name but with .json instead of .nii.gz
+    with open(image_path.replace('.nii.gz', '.json')) as sidecar_fh:
+        return json.load(sidecar_fh)
+
+
+def write_sidecar(image_path, sidecar):
+    # Serialize first and write the sidecar in one call
+    Path(image_path.replace('.nii.gz', '.json')).write_text(json.dumps(sidecar, indent=2, sort_keys=True))
+
+
+def get_phase_encoding_direction(image_path):
+    # Search the sidecar for the phase encoding direction without parsing the whole file, which may be large
+    with open(image_path.replace('.nii.gz', '.json'), 'rb') as sidecar_fh:
+        sidecar_bytes = sidecar_fh.read()
+
+    match = PE_DIRECTION_RE.search(sidecar_bytes)
+    if match is not None:
+        return match.group(1).decode()
+
+    return json.loads(sidecar_bytes)['PhaseEncodingDirection']
+
+
+def prepare_group(group, group_dwi_images):
+    # Check the metadata for one group of DWIs and write the synb0 inputs. Returns the synb0 input, output and tmp
+    # directories, fmap file name and fmap sidecar, or None if the group is skipped
+    print("Preparing synb0 input for group " + group)
+
+    # Run synb0 on the group using the first b0
+
+    dwi_ref = group_dwi_images[0]
+
+    # Parsed sidecars, only the reference is needed unless we have to add total readout time
+    sidecars = {dwi_ref.path: load_sidecar(dwi_ref.path)}
+
+    # True if we need to add total readout time to the sidecar for all DWI images in the group
+    # Without this, qsiprep won't be able to run SDC
+    # Usually only for older data where the total readout time isn't in the sidecar
+    dwi_needs_total_readout_time = 'TotalReadoutTime' not in sidecars[dwi_ref.path]
+
+    # Read each sidecar once. If they will be rewritten, parse them all now, otherwise only search the other
+    # images for their phase encoding direction
+    if dwi_needs_total_readout_time:
+        for dwi_image in group_dwi_images[1:]:
+            sidecars[dwi_image.path] = load_sidecar(dwi_image.path)
+        pe_directions = {sidecar['PhaseEncodingDirection'] for sidecar in sidecars.values()}
+    else:
+        pe_directions = {sidecars[dwi_ref.path]['PhaseEncodingDirection'],
+                         *map(get_phase_encoding_direction, (dwi_image.path for dwi_image in group_dwi_images[1:]))}
+
+    # Check all images in the group have the same phase encoding direction
+    if len(pe_directions) > 1:
+        print("Phase encoding direction not consistent for group " + group + ". Skipping group")
+        return None
+
+    pe_direction = pe_directions.pop()
+
+    print("Phase encoding direction for group " + group + " is " + pe_direction)
+
+    # Get total readout time from the first b0 or use command line alternative (needed for older DICOM files)
+    total_readout_time = args.total_readout_time
+
+    if dwi_needs_total_readout_time:
+        print("No total readout time in sidecar for " + dwi_ref.path)
+        if total_readout_time is None:
+            print("No total readout time in sidecar and no readout time specified on command line")
+            sys.exit(1)
+        print("Inserting total readout time from command line: " + str(total_readout_time))
+        # At most one write per sidecar
+        for dwi_image in group_dwi_images:
+            if sidecars[dwi_image.path].get('TotalReadoutTime') != total_readout_time:
+                sidecars[dwi_image.path]['TotalReadoutTime'] = total_readout_time
+                write_sidecar(dwi_image.path, sidecars[dwi_image.path])
+    else:
+        total_readout_time = sidecars[dwi_ref.path]['TotalReadoutTime']
+
+    # These are inputs and output for this group under the top working directory
+    working_path = Path(working_dir)
+    tmp_input_dir = working_path / f"{group}_synb0_input"
+    tmp_output_dir = working_path / f"{group}_synb0_output"
+    # Mount this to /tmp for the container
+    tmp_singularity_dir = working_path / f"{group}_synb0_tmpdir"
+
+    os.makedirs(tmp_input_dir)
+    os.makedirs(tmp_output_dir)
+    os.makedirs(tmp_singularity_dir)
+
+    # Get the first b0 image from the DWI
+    b0_input = tmp_input_dir / 'b0.nii.gz'
+
+    # Slicing the image proxy reads only the first volume
+    try:
+        nib.save(nib.load(dwi_ref.path).slicer[..., 0:1], b0_input)
+    except Exception as e:
+        print("Could not extract b0 image from " + dwi_ref.path + ": " + str(e))
+        sys.exit(1)
+
+    t1_input = tmp_input_dir / 'T1.nii.gz'
+
+    # Copy rather than link, /INPUTS is writable in the container and groups may run at the same time
+    if t1w_is_skull_stripped:
+        shutil.copy(t1w_skull_stripped_path, t1_input)
+    else:
+        shutil.copy(t1w_path, t1_input)
+
+    # Not sure why it requires this if not running topup
+    with open(tmp_input_dir / 'acqparams.txt', 'w') as acqparams_fh:
+        acqparams_fh.write(ACQPARAMS_TEMPLATE[pe_direction].format(trt=total_readout_time))
+
+    fmap_file_name = None
+
+    fmap_phase_encode_dir = phase_encode_flip[pe_direction]
+
+    fmap_phase_encode_label = phase_encode_labels[fmap_phase_encode_dir]
+
+    if group == 'noacq':
+        fmap_file_name = f"sub-{args.participant_label}_ses-{args.session_label}_acq-synb0_dir-{fmap_phase_encode_label}_epi.nii.gz"
+    else:
+        fmap_file_name = f"sub-{args.participant_label}_ses-{args.session_label}_acq-{group}synb0_dir-{fmap_phase_encode_label}_epi.nii.gz"
+
+    # The fmap sidecar is the reference DWI sidecar with the IntendedFor field, flipped phase encode, and
+    # echo spacing and total readout time for the undistorted image
+    fmap_sidecar = dict(sidecars[dwi_ref.path])
+    fmap_intended_files = sorted(session_dwi_prefix + file.filename for file in group_dwi_images)
+    fmap_sidecar['IntendedFor'] = fmap_intended_files
+    fmap_sidecar['PhaseEncodingDirection'] = fmap_phase_encode_dir
+    fmap_sidecar['TotalReadoutTime'] = 0.0000001
+    fmap_sidecar['EffectiveEchoSpacing'] = 0.0
+
+    return tmp_input_dir, tmp_output_dir, tmp_singularity_dir, fmap_file_name, fmap_sidecar
+
+
+def run_synb0(tmp_input_dir, tmp_output_dir, tmp_singularity_dir):
+    # Run the synb0 container on prepared input
+    synb0_cmd_list = ['singularity', 'run', '--cleanenv', '--no-home', '-B', f"{tmp_input_dir}:/INPUTS",
+                      '-B', f"{tmp_output_dir}:/OUTPUTS",
+                      '-B', f"{tmp_singularity_dir}:/tmp",
+                      '-B', f"{fs_license_file}:/extra/freesurfer/license.txt",
+                args.container, '--notopup']
+
+    if t1w_is_skull_stripped:
+        synb0_cmd_list.append('--stripped')
+
+    print("---synb0 call---\n" + " ".join(synb0_cmd_list) + "\n---")
+
+    # Fail here rather than when looking for the output
+    subprocess.run(synb0_cmd_list, env=synb0_env, check=True)
+
+
+# We need to put dir-<pe_direction> in the filename for the fmap/ to be BIDS compliant
+# The BIDS sidecar has letter codes i, i-, j, j-. I believe that k, k- are not supported by topup/eddy
+
+# for acqparams.txt, we need vectors in 3D
+phase_encode_vectors = {'i': (1, 0, 0), 'i-': (-1, 0, 0), 'j': (0, 1, 0), 'j-': (0, -1, 0), 'k': (0, 0, 1), 'k-': (0, 0, -1)}
+
+# the synthetic b0 has the opposite phase encoding direction to the DWI
+phase_encode_flip = {'i': 'i-', 'i-': 'i', 'j': 'j-', 'j-': 'j', 'k': 'k-', 'k-': 'k'}
+
+# for file names, we use letter labels. Note IS, SI are not supported
+phase_encode_labels = {'i': 'RL', 'i-': 'LR', 'j': 'PA', 'j-': 'AP'}
+
+# acqparams.txt contents for each phase encoding direction, the second row is the undistorted synthetic b0
+ACQPARAMS_TEMPLATE = {pe: f"{v[0]} {v[1]} {v[2]} {{trt}}\n{v[0]} {v[1]} {v[2]} 0.000\n"
+                      for pe, v in phase_encode_vectors.items()}
+
 
 # parse arguments with argparse
 # if no args, print usage
@@ -113,7 +364,7 @@ script will exit. Use a filter or the --t1w-image-suffix option to select a spec
    Coronal scans should work if the PE is along RL or LR, but this is untested.
 
 
-Requires: FSL, singularity
+Requires: singularity
 
                                  ''')
 
@@ -126,16 +377,27 @@ required.add_argument("--session-label", help="session to process", type=str, re
 
 optional = parser.add_argument_group('Optional arguments')
 optional.add_argument("-h", "--help", action="help", help="show this help message and exit")
-optional.add_argument("-f", "--bids-filter", help="BIDS filter file", type=str, default=None)
+optional.add_argument("-f", "--bids-filter", help="BIDS filter file, with filters for the 't1w' and 'dwi' "
+                      "images", type=str, default=None)
+optional.add_argument("--pybids-db", help="Directory for a pybids database to share between jobs. The first job "
+                      "indexes the whole dataset, later jobs reuse the index. The database is rebuilt if "
+                      "dataset_description.json is newer than it, or if the session is not in it. Remove it if "
+                      "other files in the dataset change. Not used with --t1w-image-suffix and no BIDS filter, "
+                      "because the dataset is not indexed then. "
+                      "If not specified, only the participant and session are indexed", type=str, default=None)
 optional.add_argument("-n", "--num-threads", help="Number of computational threads", type=int, default=1)
+optional.add_argument("-p", "--max-parallel-groups", help="Maximum number of DWI groups to run synb0 on at once. Each "
+                      "group uses --num-threads threads, so the job needs num_threads * max_parallel_groups "
+                      "cores", type=int, default=1)
 optional.add_argument("-t", "--total-readout-time", help="Total readout time for DWI. Some older DICOM files "
                       "do not provide this information, so it can be specified manually. Ignored if the BIDS "
-                      "sidecar contains total readout time", type=str, default=None)
+                      "sidecar contains total readout time", type=float, default=None)
 optional.add_argument("--combine-all-dwis", help="Combine all DWIs into one group. Useful for when the acq-label is not "
                       "sufficient to group scans", action='store_true')
 optional.add_argument("--t1w-image-suffix", help="Use a specific T1w head image suffix. Eg, 'acq-mprage_T1w.nii.gz' selects "
                       "sub-participant/ses-session/sub-participant_ses-session_acq-mprage_T1w.nii.gz'. "
-                      "Using this overrides BIDS filters for the T1w", type=str, default=None)
+                      "Using this overrides BIDS filters for the T1w. Without a BIDS filter, this also skips indexing "
+                      "the dataset with pybids", type=str, default=None)
 optional.add_argument("--t1w-mask-dataset", help="BIDS dataset to use for brain masking the T1w. If not specified, "
                       "the T1w dataset will be searched for an available mask. If no mask is found, synB0's internal "
                       "BET call is used for brain masking - it is highly recommended to use a high-quality brain mask "
@@ -146,19 +408,43 @@ optional.add_argument("-w", "--work-dir", help="Temp dir for intermediate output
 
 args = parser.parse_args()
 
-# open the BIDS dataset
-# Get only selected participant, speeds up processing
-ignore_pattern = re.compile(r'^(?!.*/sub-' + args.participant_label + r'($|/))')
-indexer = bids.BIDSLayoutIndexer(validate=False, ignore=[ignore_pattern])
-layout = bids.BIDSLayout(args.bids_dataset, indexer=indexer)
+# open the BIDS dataset, only needed to apply a BIDS filter or to search for the T1w. Otherwise, images are found
+# directly and the dataset is not indexed
+need_layout = args.bids_filter is not None or args.t1w_image_suffix is None
+layout = None
+
+if not need_layout and args.pybids_db is not None:
+    print("Not using pybids database " + args.pybids_db + ", the dataset is not indexed when --t1w-image-suffix "
+          "is given without a BIDS filter")
+
+if need_layout:
+    # Metadata is read directly from the sidecars below, so don't index it
+    if args.pybids_db is not None:
+        # A shared database has to contain all participants
+        indexer = bids.BIDSLayoutIndexer(validate=False, index_metadata=False)
+    else:
+        # Get only selected participant and session, speeds up processing
+        participant_pattern = re.escape(args.participant_label)
+        session_pattern = re.escape(args.session_label)
+        ignore_patterns = [re.compile(r'^(?!.*/sub-' + participant_pattern + r'($|/))'),
+                           re.compile(r'/sub-' + participant_pattern + r'/ses-(?!' + session_pattern + r'($|/))')]
+        indexer = bids.BIDSLayoutIndexer(validate=False, ignore=ignore_patterns, index_metadata=False)
+
+    layout = get_layout(args.bids_dataset, indexer, args.participant_label, args.session_label, args.pybids_db)
 
 # Get filter if provided
 bids_filters = {}
 if args.bids_filter is not None:
-    filter = get_bids_filters(args.bids_filter)
+    bids_filters = get_bids_filters(args.bids_filter)
 
 # Get all dMRI data files for the given subject and session
-dwi_groups = get_dwi_images(layout, args.participant_label, args.session_label, bids_filters)
+# Without a filter, the DWI directory is listed directly rather than queried through pybids
+if args.bids_filter is not None:
+    dwi_images = get_dwi_images(layout, args.participant_label, args.session_label, bids_filters.get('dwi', {}))
+else:
+    dwi_images = get_session_images(args.bids_dataset, args.participant_label, args.session_label, 'dwi', 'dwi')
+
+dwi_groups = group_by_acquisition(dwi_images)
 
 if (args.combine_all_dwis):
     # Combine all DWIs into one group - useful for when the acq-label is not consistent but
@@ -171,7 +457,7 @@ if args.t1w_image_suffix is not None:
 else:
     # return type files gets actual files not BIDSFile objects
     t1w_files = layout.get(subject=args.participant_label, session=args.session_label, suffix='T1w',
-                           return_type='file', extension=['nii.gz'], **bids_filters)
+                           return_type='file', extension=['nii.gz'], **bids_filters.get('t1w', {}))
 
 if (len(t1w_files) > 1):
     print("More than one T1w image found for subject " + args.participant_label + " session " + args.session_label +
@@ -197,7 +483,12 @@ t1w_is_skull_stripped = False
 
 # will be cleaned up after the script finishes
 working_dir_tmpdir = tempfile.TemporaryDirectory(prefix=f"bids-synb0.", dir=args.work_dir, ignore_cleanup_errors=True)
-working_dir = working_dir_tmpdir.name
+# Resolve symlinks once, paths created under here are real paths and can be bound into the container directly
+working_dir = os.path.realpath(working_dir_tmpdir.name)
+fs_license_file = os.path.realpath(args.fs_license_file)
+
+# DWI directory relative to the subject, for IntendedFor. BIDS paths always use '/'
+session_dwi_prefix = f"ses-{args.session_label}/dwi/"
 
 # Print the files we're processing
 print("Processing subject " + args.participant_label + " session " + args.session_label)
@@ -219,165 +510,47 @@ else:
     print("No T1w brain mask found for subject " + args.participant_label + " session " + args.session_label)
 
 
-# Run synb0 on each group of DWIs
-for group in dwi_groups:
-    print("Running synb0 on group " + group)
-    # Check all images in the group have the same phase encoding direction
-    pe_direction = None
-    pe_direction_consistent = True
-    group_dwi_images = dwi_groups[group]
-    for dwi_image in group_dwi_images:
-        print("Checking phase encoding direction for " + dwi_image.filename)
-        # Get the phase encoding direction from the image metadata
-        # Metadata is stored in the JSON sidecar file, same file name but with .json instead of
-        # .nii.gz
-        sidecar_file = dwi_image.path.replace('.nii.gz', '.json')
-        with open(sidecar_file) as sidecar_fh:
-            sidecar = json.load(sidecar_fh)
-            if pe_direction is not None:
-                if pe_direction != sidecar['PhaseEncodingDirection']:
-                    print("Phase encoding direction for " +  dwi_image.filename + " does not match previous images in group")
-                    pe_direction_consistent = False
-            else:
-                pe_direction = sidecar['PhaseEncodingDirection']
-
-    if not pe_direction_consistent:
-        print("Phase encoding direction not consistent for group " + group + ". Skipping group")
-        continue
+if shutil.which('singularity') is None:
+    raise RuntimeError('singularity executable not found')
 
-    print("Phase encoding direction for group is " + pe_direction)
-
-    # Run synb0 on the group using the first b0
+# Environment for the synb0 container, shared by all groups
+synb0_env = {**os.environ,
+             'SINGULARITYENV_TMPDIR': '/tmp',
+             'SINGULARITYENV_OMP_NUM_THREADS': str(args.num_threads),
+             'SINGULARITYENV_ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(args.num_threads)}
 
-    dwi_ref = group_dwi_images[0]
-
-    # Get total readout time from the first b0 or use command line alternative (needed for older DICOM files)
-    total_readout_time = args.total_readout_time
-    dwi_ref_sidecar_file = dwi_ref.path.replace('.nii.gz', '.json')
-
-    # True if we need to add total readout time to the sidecar for all DWI images in the group
-    # Without this, qsiprep won't be able to run SDC
-    # Usually only for older data where the total readout time isn't in the sidecar
-    dwi_needs_total_readout_time = False
-
-    with open(dwi_ref_sidecar_file) as sidecar_fh:
-        sidecar = json.load(sidecar_fh)
-        try:
-            total_readout_time = sidecar['TotalReadoutTime']
-        except KeyError:
-            dwi_needs_total_readout_time = True
-            print("No total readout time in sidecar for " + dwi_ref.path)
-            if total_readout_time is None:
-                print("No total readout time in sidecar and no readout time specified on command line")
-                sys.exit(1)
+# Check metadata and write synb0 input for all groups before running any containers, so that problems with the
+# input stop the script before any long-running jobs start
+group_inputs = {}
 
-    if dwi_needs_total_readout_time:
-        for dwi_image in group_dwi_images:
-            sidecar_file = dwi_ref.path.replace('.nii.gz', '.json')
-            print("Inserting total readout time from command line: " + total_readout_time)
-            with open(sidecar_file) as sidecar_fh:
-                sidecar = json.load(sidecar_fh)
-                sidecar['TotalReadoutTime'] = total_readout_time
-            with open(sidecar_file, 'w') as sidecar_fh:
-                json.dump(sidecar, sidecar_fh, indent=2, sort_keys=True)
-
-    # We need to put dir-<pe_direction> in the filename for the fmap/ to be BIDS compliant
-    # The BIDS sidecar has letter codes i, i-, j, j-. I believe that k, k- are not supported by topup/eddy
-
-    # for acqparams.txt, we need vectors in 3D
-    phase_encode_vectors = {'i': [1, 0, 0], 'i-': [-1, 0, 0], 'j': [0, 1, 0], 'j-': [0, -1, 0], 'k': [0, 0, 1], 'k-': [0, 0, -1]}
-
-    # for file names, we use letter labels. Note IS, SI are not supported
-    phase_encode_labels = {'i': 'RL', 'i-': 'LR', 'j': 'PA', 'j-': 'AP'}
-
-    synb0_env = os.environ.copy()
-    synb0_env['SINGULARITYENV_TMPDIR'] = '/tmp'
-    synb0_env['SINGULARITYENV_OMP_NUM_THREADS'] = str(args.num_threads)
-    synb0_env['SINGULARITYENV_ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(args.num_threads)
-
-    # These are inputs and output for this group under the top working directory
-    tmp_input_dir = os.path.join(working_dir, f"{group}_synb0_input")
-    tmp_output_dir = os.path.join(working_dir, f"{group}_synb0_output")
-    # Mount this to /tmp for the container
-    tmp_singularity_dir = os.path.join(working_dir, f"{group}_synb0_tmpdir")
-
-    os.makedirs(tmp_input_dir)
-    os.makedirs(tmp_output_dir)
-    os.makedirs(tmp_singularity_dir)
-
-    # Get the first b0 image from the DWI
-    b0_input = os.path.join(tmp_input_dir, 'b0.nii.gz')
-
-    # fslroi exits 0 if the file doesn't exist, so check manually
-    subprocess.run(['fslroi', dwi_ref.path, b0_input, '0', '1'], env=synb0_env)
-    if not os.path.exists(b0_input):
-        print("Could not extract b0 image from " + dwi_ref.path)
-        sys.exit(1)
-
-    t1_input = os.path.join(tmp_input_dir, 'T1.nii.gz')
-
-    if t1w_is_skull_stripped:
-        shutil.copy(t1w_skull_stripped_path, t1_input)
-    else:
-        shutil.copy(t1w_path, t1_input)
-
-    # Not sure why it requires this if not running topup
-    with open(os.path.join(tmp_input_dir, 'acqparams.txt'), 'w') as acqparams_fh:
-        # write phase_encode_vectors['pe_direction']
-        acqparams_fh.write(' '.join([str(x) for x in phase_encode_vectors[pe_direction]]) +
-                            ' ' + str(total_readout_time) + '\n')
-        acqparams_fh.write(' '.join([str(x) for x in phase_encode_vectors[pe_direction]]) +
-                            ' ' + '0.000' + '\n')
-
-    if shutil.which('singularity') is None:
-        raise RuntimeError('singularity executable not found')
-
-    # Get synb0 output and copy to fmap/
-    synb0_cmd_list = ['singularity', 'run', '--cleanenv', '--no-home', '-B', f"{os.path.realpath(tmp_input_dir)}:/INPUTS",
-                      '-B', f"{os.path.realpath(tmp_output_dir)}:/OUTPUTS",
-                      '-B', f"{os.path.realpath(tmp_singularity_dir)}:/tmp",
-                      '-B', f"{os.path.realpath(args.fs_license_file)}:/extra/freesurfer/license.txt",
-                args.container, '--notopup']
-
-    if t1w_is_skull_stripped:
-        synb0_cmd_list.append('--stripped')
-
-    print("---synb0 call---\n" + " ".join(synb0_cmd_list) + "\n---")
-
-    subprocess.run(synb0_cmd_list, env=synb0_env)
-
-    fmap_file_name = None
-
-    fmap_phase_encode_dir = pe_direction[:-1] if pe_direction[-1] == '-' else pe_direction + '-'
+for group in dwi_groups:
+    group_input = prepare_group(group, dwi_groups[group])
+    if group_input is not None:
+        group_inputs[group] = group_input
 
-    fmap_phase_encode_label = phase_encode_labels[fmap_phase_encode_dir]
+# Run synb0 on each group of DWIs. Each group runs in its own container with num_threads threads
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(group_inputs), args.max_parallel_groups)))
 
-    if group == 'noacq':
-        fmap_file_name = f"sub-{args.participant_label}_ses-{args.session_label}_acq-synb0_dir-{fmap_phase_encode_label}_epi.nii.gz"
-    else:
-        fmap_file_name = f"sub-{args.participant_label}_ses-{args.session_label}_acq-{group}synb0_dir-{fmap_phase_encode_label}_epi.nii.gz"
+try:
+    group_futures = {group: executor.submit(run_synb0, *group_inputs[group][:3]) for group in group_inputs}
 
-    # output_dir is fmap/ under the session directory in the dataset
-    output_dir = os.path.join(args.bids_dataset, f"sub-{args.participant_label}", f"ses-{args.session_label}", 'fmap')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    # Write output in group order as each group finishes
+    for group, group_future in group_futures.items():
+        group_future.result()
 
-    shutil.copy(os.path.join(tmp_output_dir, 'b0_u.nii.gz'), os.path.join(output_dir, fmap_file_name))
+        _, tmp_output_dir, _, fmap_file_name, fmap_sidecar = group_inputs[group]
 
-    fmap_sidecar_file = fmap_file_name.replace('.nii.gz', '.json')
-    shutil.copy(dwi_ref_sidecar_file, os.path.join(output_dir, fmap_sidecar_file))
+        # output_dir is fmap/ under the session directory in the dataset
+        output_dir = os.path.join(args.bids_dataset, f"sub-{args.participant_label}", f"ses-{args.session_label}", 'fmap')
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
 
-    # Edit the sidecar file to add the IntendedFor field, flip phase encode, and add echo spacing
-    # and total readout time
-    with open(os.path.join(output_dir, fmap_sidecar_file), 'r') as fmap_sidecar_fh:
-        fmap_sidecar = json.load(fmap_sidecar_fh)
-        fmap_intended_files = [os.path.join(f"ses-{args.session_label}", 'dwi', file.filename) for file in group_dwi_images]
-        fmap_sidecar['IntendedFor'] = fmap_intended_files
-        # flip pe, if i, set to i-, if i-, set to i
-        fmap_sidecar['PhaseEncodingDirection'] = fmap_phase_encode_dir
-        fmap_sidecar['TotalReadoutTime'] = 0.0000001
-        fmap_sidecar['EffectiveEchoSpacing'] = 0.0
+        link_or_copy(tmp_output_dir / 'b0_u.nii.gz', os.path.join(output_dir, fmap_file_name))
 
-    with open(os.path.join(output_dir, fmap_sidecar_file), 'w') as fmap_sidecar_fh:
-        json.dump(fmap_sidecar, fmap_sidecar_fh, indent=2, sort_keys=True)
+        write_sidecar(os.path.join(output_dir, fmap_file_name), fmap_sidecar)
+except BaseException:
+    # Don't start synb0 on any remaining groups if one fails
+    executor.shutdown(wait=False, cancel_futures=True)
+    raise
 
+executor.shutdown()